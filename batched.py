@@ -0,0 +1,182 @@
+import numpy as np
+
+try:
+    import cupy as cp
+    import cupyx
+except ImportError:
+    cp = None
+
+from terrain import update_gradient
+
+# NumPy version of the droplet simulation, for when numba isn't available.
+# The whole batch is simulated at once: the droplet state is kept as arrays
+# (one entry per droplet) and every time step updates all the droplets still
+# alive with vectorized operations. Same physics and interface as kernels.simulate_batch:
+# the terrain changes of every step are held and added to terrain at the end of the batch
+# If terrain, grad and dirty are cupy arrays the same code runs on the GPU
+
+
+# Every how many steps the dead droplets get removed from the state arrays
+compact_every = 16
+
+
+def scatter_add(a, idx, values):
+    """
+    a[idx] += values, adding up repeated indices (np.add.at / cupyx.scatter_add)
+    """
+    if cp is not None and isinstance(a, cp.ndarray):
+        cupyx.scatter_add(a, idx, values)
+    else:
+        np.add.at(a, idx, values)
+
+
+def simulate_batch(terrain, grad, dirty, starts, params, max_steps):
+    """
+    Runs a batch of droplets together, one for each (x0, y0) row of starts.
+    Their changes are added to terrain at the end and grad is updated around them
+
+    :param terrain: np.array (or cupy array) with the terrain
+    :param grad: gradient of the terrain as a single (height, width, 2) array, on the same device as terrain
+    :param dirty: boolean scratch array the size of terrain, all False before and after
+    :param starts: (n_droplets, 2) integer np.array with the starting cells
+    :param params: DropletParams
+    :param max_steps: max number of steps of each droplet
+
+    :returns: steps and max speed of each droplet, as np.arrays
+    """
+    xp = cp.get_array_module(terrain) if cp is not None else np
+    height, width = terrain.shape
+    n_droplets = starts.shape[0]
+
+    starts = xp.asarray(starts)
+    ix = starts[:, 0].astype(np.intp)
+    iy = starts[:, 1].astype(np.intp)
+    # Estado en float32 como el terreno, la mitad de memoria por operacion
+    px = ix.astype(np.float32)
+    py = iy.astype(np.float32)
+    vx = xp.zeros(n_droplets, dtype=np.float32)
+    vy = xp.zeros(n_droplets, dtype=np.float32)
+    sediment = xp.full(n_droplets, params.initial_sediment, dtype=np.float32)
+    volume = xp.full(n_droplets, params.initial_volume, dtype=np.float32)
+
+    alive = xp.ones(n_droplets, dtype=bool)
+    steps = xp.zeros(n_droplets, dtype=np.int64)
+    speeds = xp.zeros(n_droplets, dtype=np.float32)
+    # Factores constantes de cada paso, calculados una sola vez
+    dt_g = params.dt * params.g
+    friction_mul = 1 - params.dt * params.friction
+    evap_mul = 1 - params.evaporation_rate * params.dt
+
+    # 3x3 erosion kernel [[1,2,1],[2,4,2],[1,2,1]]/16 as offsets and weights
+    kernel_di = xp.asarray([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+    kernel_dj = xp.asarray([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+    kernel_w = ((2 - abs(kernel_di)) * (2 - abs(kernel_dj)) / 16).astype(np.float32)
+
+    # Vistas planas de terrain y dirty para los scatters
+    terrain_flat = terrain.reshape(-1)
+    dirty_flat = dirty.reshape(-1)
+
+    # Droplet (row of starts) each entry of the state arrays belongs to
+    ids = xp.arange(n_droplets)
+
+    # Cambios al terreno de cada paso (indices planos y valores), se suman al final
+    delta_idx, delta_val = [], []
+
+    for it in range(max_steps):
+        # Cada tanto saco las gotas muertas del estado, asi no se sigue operando sobre ellas
+        if it % compact_every == 0:
+            keep = xp.flatnonzero(alive)
+            ids, ix, iy, px, py, vx, vy, sediment, volume, alive = (
+                ids[keep], ix[keep], iy[keep], px[keep], py[keep],
+                vx[keep], vy[keep], sediment[keep], volume[keep], alive[keep])
+        if not alive.any():
+            break
+        steps[ids] += alive
+
+        # Dinamica, the position of dead droplets stays where they were
+        # Pendiente interpolada bilinealmente en la posicion de cada gota,
+        # cada gather trae las dos componentes juntas
+        fx = (px - ix.astype(np.float32))[:, None]
+        fy = (py - iy.astype(np.float32))[:, None]
+        slopes = ((1 - fx) * (1 - fy) * grad[ix, iy] + fx * (1 - fy) * grad[ix + 1, iy]
+                  + (1 - fx) * fy * grad[ix, iy + 1] + fx * fy * grad[ix + 1, iy + 1])
+        vx -= dt_g * slopes[:, 0]
+        vy -= dt_g * slopes[:, 1]
+        px = xp.where(alive, px + params.dt * vx, px)
+        py = xp.where(alive, py + params.dt * vy, py)
+        vx *= friction_mul
+        vy *= friction_mul
+
+        # Check q esta en la grilla
+        alive &= (px >= 0) & (px < height - 1) & (py >= 0) & (py < width - 1)
+
+        # Erosion/Sedimentation
+        nx = xp.where(alive, px, ix).astype(np.intp)
+        ny = xp.where(alive, py, iy).astype(np.intp)
+        Deltah = xp.where(alive, terrain[nx, ny] - terrain[ix, iy], 0)
+        moving = Deltah != 0
+
+        speed = xp.sqrt(vx * vx + vy * vy)
+        speeds[ids] = xp.maximum(speeds[ids], xp.where(moving, speed, 0))
+        capacity = -Deltah * speed * volume * params.p_c
+
+        # ---Sedimentation
+        # If it goes uphill all sediment is deposited until Deltah gets to 0
+        uphill = moving & (Deltah > 0)
+        # If it carries more sediment than its capacity adjust until capacity or Deltah gets to 0
+        over = moving & ~uphill & (sediment > capacity)
+        # ---Erosion
+        # If it carries less sediment than its capacity adjust until capacity
+        erode = moving & ~uphill & ~over
+
+        s_diff = xp.zeros(ids.size, dtype=np.float32)
+        s_diff = xp.where(uphill, xp.minimum(sediment, Deltah) * params.deposition_rate, s_diff)
+        s_diff = xp.where(over, xp.minimum(sediment - capacity, -Deltah) * params.deposition_rate, s_diff)
+        s_diff = xp.where(erode, -xp.minimum(capacity - sediment, -Deltah) * params.erosion_rate, s_diff)
+
+        # Changes to terrain as flat indices, applied together at the end of the batch
+        deposit = uphill | over
+        deposit_idx = ix[deposit] * width + iy[deposit]
+
+        # 3x3 erosion kernel centred on the droplet cell. On the border the taps outside
+        # the grid get weight 0 and their weight goes to the centre (column 4), so the
+        # eroded mass doesn't change
+        ki = ix[erode][:, None] + kernel_di
+        kj = iy[erode][:, None] + kernel_dj
+        inside = (ki >= 0) & (ki < height) & (kj >= 0) & (kj < width)
+        weights = xp.where(inside, kernel_w, 0).astype(np.float32)
+        weights[:, 4] += xp.where(inside, 0, kernel_w).sum(axis=1)
+        erosion_idx = xp.clip(ki, 0, height - 1) * width + xp.clip(kj, 0, width - 1)
+        erosion_val = s_diff[erode][:, None] * weights
+
+        sediment -= s_diff
+
+        # Set new index position
+        ix, iy = nx, ny
+
+        # Evaporation
+        volume = xp.where(alive, volume * evap_mul, volume)
+
+        evaporated = alive & (volume <= params.min_volume)
+        alive &= ~evaporated
+
+        delta_idx += [deposit_idx, erosion_idx.ravel(), ix[evaporated] * width + iy[evaporated]]
+        delta_val += [s_diff[deposit], erosion_val.ravel(), sediment[evaporated]]
+
+    # Un solo scatter_add para todo el batch (deposito, erosion y evaporacion), asi
+    # las gotas q caen en la misma celda se suman todas y durante el batch el terreno
+    # no cambia, como en kernels.simulate_batch
+    if delta_idx:
+        idx = xp.concatenate(delta_idx)
+        scatter_add(terrain_flat, idx, xp.concatenate(delta_val))
+        if xp is np:
+            dirty_flat[idx] = True
+
+    if xp is np:
+        update_gradient(terrain, grad, dirty)
+        dirty[:] = False
+        return steps, speeds
+
+    # En la GPU sale mas barato recalcular todo el gradiente, dirty ni se toca
+    grad[...] = xp.stack(xp.gradient(terrain), axis=-1)
+    return cp.asnumpy(steps), cp.asnumpy(speeds)
@@ -8,6 +8,12 @@ import bpy
 import numpy as np
 import os
 
+try:
+    import pandas as pd
+except ImportError:
+    # pandas is not bundled with Blender, text files fall back to np.loadtxt
+    pd = None
+
 class TerrainImporter:
     """GUI-friendly terrain importer with interactive controls"""
     
@@ -17,17 +23,31 @@ class TerrainImporter:
         self.cols = 0
         self.obj = None
         
-    def load_terrain(self, filepath):
-        """Load terrain from text file"""
-        print(f"Loading terrain from {filepath}")
-        
+    def load_terrain(self, filepath, verbose=False):
+        """
+        Load terrain from a text or .npy file, or take it directly from a np.array
+        (verbose also prints the height range)
+        """
         try:
-            # Load terrain data
-            self.terrain = np.loadtxt(filepath)
+            if isinstance(filepath, np.ndarray):
+                # Already in memory (e.g. straight from the simulation), nothing to read
+                print("Loading terrain from array")
+                self.terrain = filepath.astype(np.float32, copy=False)
+            else:
+                print(f"Loading terrain from {filepath}")
+                # Load terrain data, from the binary .npy next to the text file if there is one
+                if os.path.exists(os.path.splitext(filepath)[0] + ".npy"):
+                    self.terrain = np.load(os.path.splitext(filepath)[0] + ".npy").astype(np.float32, copy=False)
+                elif pd is not None:
+                    self.terrain = pd.read_csv(filepath, sep=r"\s+", header=None,
+                                               dtype=np.float32, engine="c").to_numpy()
+                else:
+                    self.terrain = np.loadtxt(filepath).astype(np.float32)
             self.rows, self.cols = self.terrain.shape
             
             print(f"✓ Loaded terrain: {self.rows}x{self.cols}")
-            print(f"  Height range: {self.terrain.min():.3f} to {self.terrain.max():.3f}")
+            if verbose:
+                print(f"  Height range: {self.terrain.min():.3f} to {self.terrain.max():.3f}")
             
             return True
         except Exception as e:
@@ -42,46 +62,76 @@ class TerrainImporter:
         
         print(f"Creating mesh with height scale: {height_scale}")
         
-        # Clear any existing terrain with same name
+        # Create vertices (x, y, height), one row of the grid after the other
+        ii, jj = np.indices((self.rows, self.cols), dtype=np.float32)
+        verts = np.empty((self.rows * self.cols, 3), dtype=np.float32)
+        verts[:, 0] = jj.ravel()
+        verts[:, 1] = -ii.ravel()
+        verts[:, 2] = (self.terrain.astype(np.float32) * height_scale).ravel()
+        
+        n_faces = 2 * (self.rows - 1) * (self.cols - 1)
+        
+        # An existing terrain with the same grid is reused, only its heights change
         if name in bpy.data.objects:
             old_obj = bpy.data.objects[name]
+            old_mesh = old_obj.data
+            if (old_obj.type == 'MESH'
+                    and tuple(old_mesh.get("terrain_shape", ())) == (self.rows, self.cols)
+                    and len(old_mesh.vertices) == len(verts)
+                    and len(old_mesh.polygons) == n_faces):
+                old_mesh.attributes["position"].data.foreach_set("vector", verts.ravel())
+                old_mesh.update()
+                self.obj = old_obj
+                if "terrain_obj" in bpy.context.scene.bl_rna.properties:
+                    bpy.context.scene.terrain_obj = self.obj
+                
+                print(f"✓ Updated terrain mesh: {len(verts)} vertices, {n_faces} faces")
+                return self.obj
+            
+            # Clear it otherwise, together with its mesh data
+            old_obj_type = old_obj.type
             bpy.data.objects.remove(old_obj, do_unlink=True)
+            if old_obj_type == 'MESH' and old_mesh.users == 0:
+                bpy.data.meshes.remove(old_mesh)
         
         # Create mesh data
         mesh = bpy.data.meshes.new(name)
+        mesh["terrain_shape"] = (self.rows, self.cols)
         self.obj = bpy.data.objects.new(name, mesh)
-        
-        # Create vertices
-        verts = []
-        faces = []
-        
-        for i in range(self.rows):
-            for j in range(self.cols):
-                # Create vertex (x, y, height)
-                verts.append((j, -i, self.terrain[i, j] * height_scale))
-        
-        # Create faces (quads)
-        for i in range(self.rows - 1):
-            for j in range(self.cols - 1):
-                v1 = i * self.cols + j
-                v2 = i * self.cols + (j + 1)
-                v3 = (i + 1) * self.cols + (j + 1)
-                v4 = (i + 1) * self.cols + j
-                faces.append((v1, v2, v3, v4))
-        
-        # Build mesh
-        mesh.from_pydata(verts, [], faces)
-        mesh.update()
+
+        # Create faces, each grid quad (v1, v2, v3, v4) is split into two triangles
+        # so Blender doesn't have to tessellate them. v1 is the top-left corner
+        i = np.arange(self.rows - 1)[:, None]
+        j = np.arange(self.cols - 1)[None, :]
+        v1 = (i * self.cols + j).ravel()
+        v2 = v1 + 1
+        v3 = v1 + self.cols + 1
+        v4 = v1 + self.cols
+        faces = np.stack([np.stack([v1, v2, v3], axis=1),
+                          np.stack([v1, v3, v4], axis=1)], axis=1).reshape(-1, 3).astype(np.int32)
+
+        # Build mesh, float32/int32 buffers let foreach_set memcpy them directly
+        mesh.vertices.add(len(verts))
+        mesh.attributes["position"].data.foreach_set("vector", verts.ravel())
+
+        mesh.loops.add(n_faces * 3)
+        mesh.polygons.add(n_faces)
+        mesh.polygons.foreach_set("loop_start", np.arange(0, n_faces * 3, 3, dtype=np.int32))
+        if bpy.app.version < (4, 0, 0):
+            # Read-only since 4.0, it is derived from loop_start
+            mesh.polygons.foreach_set("loop_total", np.full(n_faces, 3, dtype=np.int32))
+        mesh.loops.foreach_set("vertex_index", faces.ravel())
+
+        # Smooth shading, set directly instead of through bpy.ops.object.shade_smooth
+        mesh.polygons.foreach_set("use_smooth", np.ones(n_faces, dtype=bool))
+        mesh.update(calc_edges=True)
         
         # Link to scene
         bpy.context.collection.objects.link(self.obj)
-        
-        # Select and make active
-        bpy.context.view_layer.objects.active = self.obj
-        self.obj.select_set(True)
-        
-        # Apply smooth shading
-        bpy.ops.object.shade_smooth()
+
+        # Keep a reference on the scene so the panel doesn't have to search for it
+        if "terrain_obj" in bpy.context.scene.bl_rna.properties:
+            bpy.context.scene.terrain_obj = self.obj
         
         print(f"✓ Created terrain mesh: {len(verts)} vertices, {len(faces)} faces")
         return self.obj
@@ -117,9 +167,9 @@ class TerrainImporter:
         if cam_name in bpy.data.objects:
             camera = bpy.data.objects[cam_name]
         else:
-            bpy.ops.object.camera_add(location=(0, 0, 0))
-            camera = bpy.context.object
-            camera.name = cam_name
+            # Through bpy.data instead of bpy.ops, no operator/depsgraph round trip
+            camera = bpy.data.objects.new(cam_name, bpy.data.cameras.new(cam_name))
+            bpy.context.collection.objects.link(camera)
         
         # Position camera
         camera.location = (self.cols/2, -self.rows*2, self.rows)
@@ -134,16 +184,17 @@ class TerrainImporter:
         """Add basic lighting"""
         # Sun light
         if "Sun" not in bpy.data.objects:
-            bpy.ops.object.light_add(type='SUN', location=(10, 10, 20))
-            sun = bpy.context.object
-            sun.name = "Sun"
-            sun.data.energy = 3.0
+            sun_data = bpy.data.lights.new("Sun", type='SUN')
+            sun_data.energy = 3.0
+            sun = bpy.data.objects.new("Sun", sun_data)
+            sun.location = (10, 10, 20)
+            bpy.context.collection.objects.link(sun)
         
         print("✓ Basic lighting added")
     
-    def import_complete(self, filepath, height_scale=2.0):
-        """Complete import process"""
-        if not self.load_terrain(filepath):
+    def import_complete(self, filepath, height_scale=2.0, verbose=False):
+        """Complete import process, filepath can also be a np.array (see load_terrain)"""
+        if not self.load_terrain(filepath, verbose):
             return False
         
         self.create_mesh(height_scale)
@@ -151,13 +202,15 @@ class TerrainImporter:
         self.setup_camera()
         self.setup_lighting()
         
-        # Center view on terrain
+        # Center view on terrain (view_selected needs it selected and active)
+        bpy.context.view_layer.objects.active = self.obj
+        self.obj.select_set(True)
         bpy.ops.view3d.view_selected()
         
         print("\n" + "="*50)
         print("TERRAIN IMPORT COMPLETE!")
         print("="*50)
-        print(f"File: {os.path.basename(filepath)}")
+        print(f"File: {'array' if isinstance(filepath, np.ndarray) else os.path.basename(filepath)}")
         print(f"Size: {self.rows} x {self.cols}")
         print(f"Object: {self.obj.name}")
         print("\nYou can now:")
@@ -176,7 +229,7 @@ class TerrainImporter:
 import bpy
 from bpy.types import Panel, Operator
 from bpy_extras.io_utils import ImportHelper
-from bpy.props import StringProperty, FloatProperty
+from bpy.props import StringProperty, FloatProperty, PointerProperty
 
 class IMPORT_OT_terrain(Operator, ImportHelper):
     """Operator to import terrain from text file"""
@@ -186,7 +239,7 @@ class IMPORT_OT_terrain(Operator, ImportHelper):
     
     # Filter for text files
     filter_glob: StringProperty(
-        default="*.txt",
+        default="*.txt;*.npy",
         options={'HIDDEN'},
     )
     
@@ -243,11 +296,7 @@ class VIEW3D_PT_terrain_importer(Panel):
         col.operator("import.terrain_data", text="Import Terrain", icon='IMPORT')
         
         # Quick actions if terrain exists
-        terrain_obj = None
-        for obj in bpy.data.objects:
-            if "Terrain" in obj.name:
-                terrain_obj = obj
-                break
+        terrain_obj = context.scene.terrain_obj
         
         if terrain_obj:
             box = layout.box()
@@ -269,6 +318,49 @@ class VIEW3D_PT_terrain_importer(Panel):
 # Additional operators for terrain manipulation
 # ====================================================================
 
+HEIGHT_GROUP_NAME = "TerrainHeightGrp"
+
+def get_height_node_group():
+    """Get the height-color node group, building it the first time"""
+    group = bpy.data.node_groups.get(HEIGHT_GROUP_NAME)
+    if group is not None:
+        return group
+    
+    group = bpy.data.node_groups.new(HEIGHT_GROUP_NAME, 'ShaderNodeTree')
+    if bpy.app.version >= (4, 0, 0):
+        group.interface.new_socket("Shader", in_out='OUTPUT', socket_type='NodeSocketShader')
+    else:
+        group.outputs.new('NodeSocketShader', "Shader")
+    nodes = group.nodes
+    
+    # Add nodes
+    output = nodes.new(type='NodeGroupOutput')
+    bsdf = nodes.new(type='ShaderNodeBsdfPrincipled')
+    color_ramp = nodes.new(type='ShaderNodeValToRGB')
+    separate = nodes.new(type='ShaderNodeSeparateXYZ')
+    geometry = nodes.new(type='ShaderNodeNewGeometry')
+    
+    # Position nodes
+    output.location = (300, 0)
+    bsdf.location = (100, 0)
+    color_ramp.location = (-100, 0)
+    separate.location = (-300, 0)
+    geometry.location = (-500, 0)
+    
+    # Connect nodes
+    links = group.links
+    links.new(geometry.outputs['Position'], separate.inputs[0])
+    links.new(separate.outputs[2], color_ramp.inputs[0])
+    links.new(color_ramp.outputs[0], bsdf.inputs[0])
+    links.new(bsdf.outputs[0], output.inputs[0])
+    
+    # Setup color ramp
+    color_ramp.color_ramp.elements[0].color = (0.1, 0.2, 0.8, 1)  # Water
+    color_ramp.color_ramp.elements[1].color = (0.3, 0.6, 0.3, 1)  # Grass
+    
+    return group
+
+
 class TERRAIN_OT_add_height_material(Operator):
     """Add height-based color material"""
     bl_idname = "terrain.add_height_material"
@@ -276,46 +368,26 @@ class TERRAIN_OT_add_height_material(Operator):
     
     def execute(self, context):
         # Find terrain object
-        terrain_obj = None
-        for obj in bpy.data.objects:
-            if "Terrain" in obj.name:
-                terrain_obj = obj
-                break
+        terrain_obj = context.scene.terrain_obj
         
         if not terrain_obj:
             self.report({'WARNING'}, "No terrain object found")
             return {'CANCELLED'}
         
-        # Create node-based material
+        # Create node-based material, the height coloring comes from the shared node group
         mat = bpy.data.materials.new(name="Terrain_Height")
         mat.use_nodes = True
         nodes = mat.node_tree.nodes
         nodes.clear()
         
-        # Add nodes
         output = nodes.new(type='ShaderNodeOutputMaterial')
-        bsdf = nodes.new(type='ShaderNodeBsdfPrincipled')
-        color_ramp = nodes.new(type='ShaderNodeValToRGB')
-        separate = nodes.new(type='ShaderNodeSeparateXYZ')
-        geometry = nodes.new(type='ShaderNodeNewGeometry')
+        height_group = nodes.new(type='ShaderNodeGroup')
+        height_group.node_tree = get_height_node_group()
         
-        # Position nodes
         output.location = (300, 0)
-        bsdf.location = (100, 0)
-        color_ramp.location = (-100, 0)
-        separate.location = (-300, 0)
-        geometry.location = (-500, 0)
-        
-        # Connect nodes
-        links = mat.node_tree.links
-        links.new(geometry.outputs['Position'], separate.inputs[0])
-        links.new(separate.outputs[2], color_ramp.inputs[0])
-        links.new(color_ramp.outputs[0], bsdf.inputs[0])
-        links.new(bsdf.outputs[0], output.inputs[0])
-        
-        # Setup color ramp
-        color_ramp.color_ramp.elements[0].color = (0.1, 0.2, 0.8, 1)  # Water
-        color_ramp.color_ramp.elements[1].color = (0.3, 0.6, 0.3, 1)  # Grass
+        height_group.location = (100, 0)
+        
+        mat.node_tree.links.new(height_group.outputs[0], output.inputs[0])
         
         # Assign material
         terrain_obj.data.materials.clear()
@@ -353,6 +425,11 @@ def register():
     bpy.utils.register_class(VIEW3D_PT_terrain_importer)
     bpy.utils.register_class(TERRAIN_OT_add_height_material)
     bpy.utils.register_class(TERRAIN_OT_quick_render)
+    bpy.types.Scene.terrain_obj = PointerProperty(
+        name="Terrain",
+        description="Terrain object created by the importer",
+        type=bpy.types.Object,
+    )
     print("Terrain Importer registered!")
 
 def unregister():
@@ -361,19 +438,21 @@ def unregister():
     bpy.utils.unregister_class(VIEW3D_PT_terrain_importer)
     bpy.utils.unregister_class(TERRAIN_OT_add_height_material)
     bpy.utils.unregister_class(TERRAIN_OT_quick_render)
+    del bpy.types.Scene.terrain_obj
     print("Terrain Importer unregistered!")
 
 # ====================================================================
 # Simple direct import function (without GUI panel)
 # ====================================================================
 
-def quick_import_terrain(filepath="terrain.txt", height_scale=2.0):
+def quick_import_terrain(filepath="terrain.txt", height_scale=2.0, verbose=False):
     """
     Quick function to import terrain without GUI panel.
     Run this directly from Blender's Python console.
+    verbose also prints the height range of the terrain.
     """
     importer = TerrainImporter()
-    success = importer.import_complete(filepath, height_scale)
+    success = importer.import_complete(filepath, height_scale, verbose)
     
     if success:
         print("✓ Terrain imported successfully!")
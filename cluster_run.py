@@ -1,21 +1,16 @@
 import numpy as np
 import argparse
+import functools
+import multiprocessing
 import os
 import time
 
 from terrain import *
+from droplet import DropletParams
 
 
 def main():
 
-    cycles = 5
-    N_droplets = 100000
-    batch_size = 50
-
-    # Terrain parameters
-    shape = height, width = 256,256
-    scale = 250
-
     # particle
     initial_volume = 1
     min_volume = 0.1
@@ -36,9 +31,7 @@ def main():
     deposition_rate = .25
     initial_sediment = 0
 
-    kernel = np.array([[1,2,1],
-                    [2,4,2],
-                    [1,2,1]]) / 16
+    # El kernel de erosion ([[1,2,1],[2,4,2],[1,2,1]]/16) esta escrito en kernels.step
     
     # Command-line arguments
     parser = argparse.ArgumentParser(description="Hydraulic erosión on terrain.")
@@ -57,6 +50,19 @@ def main():
     
     parser.add_argument("--log_dir", type=str, required=True,
                         help="Directory to save logs and models.")
+    parser.add_argument("--save_txt", action="store_true",
+                        help="Also save the initial and final terrains as text, besides the .npy files.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the random starting cells of the droplets.")
+    parser.add_argument("--seeds", type=int, nargs="+", default=None,
+                        help="Run one independent simulation per seed, in parallel processes (log_dir/seed_<seed>).")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="Number of processes used with --seeds.")
+    parser.add_argument("--batch_size", type=int, default=None,
+                        help="Droplets simulated before each gradient update (default 256, 1024 with cupy).")
+    parser.add_argument("--backend", type=str, default="numba", choices=["numba", "numpy", "cupy"],
+                        help="Droplet simulation: compiled with numba, vectorized with numpy or on the GPU with cupy "
+                             "(the cupy path hasn't been tested on a GPU yet).")
     
     args = parser.parse_args()
 
@@ -68,140 +74,74 @@ def main():
     g                   = args.g
     friction            = args.k
 
+    params = DropletParams(initial_volume = initial_volume,
+                           min_volume = min_volume,
+                           evaporation_rate = evaporation_rate,
+                           dt = dt,
+                           g = g,
+                           friction = friction,
+                           p_c = p_c,
+                           erosion_rate = erosion_rate,
+                           deposition_rate = deposition_rate,
+                           initial_sediment = initial_sediment)
+
+    # Ruta absoluta, cada run hace chdir a su carpeta
+    args.log_dir = os.path.abspath(args.log_dir)
+
+    if args.seeds is None:
+        run(args.seed, args, params)
+        return
+
+    # Cada proceso corre una semilla, numba usa un solo thread por proceso
+    # para no tener mas threads que cores
+    os.environ["NUMBA_NUM_THREADS"] = "1"
+    with multiprocessing.Pool(min(args.processes, len(args.seeds))) as pool:
+        pool.map(functools.partial(run, args=args, params=params), args.seeds)
+
+
+def run(seed, args, params):
+    """
+    Generates the terrain and runs the erosion simulation, saving the terrain
+    after every cycle in the log directory
+
+    :param seed: seed of the random starting cells of the droplets
+    :param args: parsed command-line arguments
+    :param params: DropletParams
+    """
+    cycles = 5
+    N_droplets = 100000
+    max_steps = 250
+    batch_size = args.batch_size
+
+    # Terrain parameters
+    shape = height, width = 256,256
+    scale = 250
+
+    # Copia del terreno en la CPU para guardarlo
+    to_host = np.asarray
+    if args.backend == "numba":
+        from kernels import simulate_batch
+    else:
+        from batched import simulate_batch
+    if args.backend == "cupy":
+        import cupy as cp
+        to_host = cp.asnumpy
+        if batch_size is None:
+            batch_size = 1024 # la GPU recien rinde con batches grandes
+    if batch_size is None:
+        batch_size = 256
+    if args.backend == "numba":
+        # kernels.simulate_batch reserva (max_steps*9+1) deltas de 12 bytes (int64 + float32)
+        # por gota, el batch se limita para q no pasen de ~64 MB
+        batch_size = min(batch_size, 64 * 2**20 // ((max_steps*9 + 1) * 12))
+    print(f"batch size: {batch_size}")
+
+    # Con varias semillas cada run va en su propia carpeta
     log_dir = args.log_dir
+    if args.seeds is not None:
+        log_dir = os.path.join(log_dir, f"seed_{seed}")
     os.makedirs(log_dir, exist_ok=True)
-    os.chdir(f"{os.getcwd()}/{log_dir}")
-
-    class droplet():
-        """
-        Water droplet
-        """
-        def __init__(self, height, width, erosion_kernel = np.array([1])):
-            self.inbounds = True
-            # Dsp esto lo puede tener una clase que sea el terreno
-            self.height = height
-            self.width = width
-            
-            self.sediment = initial_sediment # masa de sedimento
-            self.volume = initial_volume # tamaño gota, se ira evaporando
-            
-            # Erosion Kernel
-            if erosion_kernel.shape[0] == erosion_kernel.shape[1]:
-                self.erosion_radius = (erosion_kernel.shape[0]-1)//2
-                self.kernel = np.array(erosion_kernel)
-            else:
-                print("Kernel Error, not square")
-            
-            # Variables dinamicas de la gota
-            self.ipos = np.random.randint([0,0],[height-1, width-1], 2)
-            self.pos = np.array(self.ipos, float)
-            self.vel = np.zeros(2)
-
-            self.max_speed = 0
-
-        def reset(self):
-            """
-            Resets variables
-            """
-            self.inbounds = True
-            self.sediment = initial_sediment
-            self.volume = initial_volume
-
-            self.ipos = np.random.randint([0,0],[self.height-1, self.width-1], 2)
-            self.pos = np.array(self.ipos, float)
-            self.vel = np.zeros(2)
-
-            self.max_speed = 0
-
-        def is_inbounds(self)->bool:
-            """
-            Checks if the droplet is still on the map
-            """
-            # Podria cambiar esto por un try:except Index en la parte del step
-            # xq creo q el indexing de python ya checkea esto, asi q seria al dope hacerlo dos veces
-            if self.pos[0] >= self.height - 1 or self.pos[1] >= self.width - 1:
-                return False
-            elif self.pos[0] < 0 or self.pos[1] < 0:
-                return False
-            else: 
-                return True
-        
-        def is_still(self, speed, slope)->bool:
-            """
-            Checks if the droplet stopped and won't move
-            """
-            if (speed < min_speed) and (slope < min_slope):
-                return True
-            else: 
-                return False
-                
-
-        def step(self, terrain, grad_terrain):
-            
-            if not self.inbounds:
-                print("step not executed, out of bounds")
-                return
-            if self.volume <= min_volume:
-                print("step not executed, droplet evaporated")
-                return
-
-            # Dinamica
-            slope = np.array((grad_terrain[0][*self.ipos],grad_terrain[1][*self.ipos]))
-
-            self.vel -= dt*slope*g
-            self.pos += dt*self.vel # + dt**2 * slope * g / 2
-            self.vel *= (1-dt*friction)
-            
-            # Check q esta en la grilla
-            if not self.is_inbounds():
-                # print("out of bounds")
-                self.inbounds = False
-                return 
-
-            # Erosion/Sedimentation
-            Deltah = terrain[*np.array(self.pos,int)] - terrain[*self.ipos]
-            if not (Deltah == 0):
-                speed = np.sqrt(self.vel.dot(self.vel))
-                if speed > self.max_speed:
-                    self.max_speed = speed
-
-                capacity = -Deltah * speed * self.volume * p_c
-
-                # ---Sedimentation
-                # If it goes uphill all sediment is deposited until Deltah gets to 0
-                if Deltah > 0:
-                    s_diff = min(self.sediment, Deltah) * deposition_rate
-                    terrain[*self.ipos] += s_diff
-
-                # If it carries more sediment than its capacity adjust until capacity or Deltah gets to 0
-                elif self.sediment > capacity:
-                    s_diff = min((self.sediment-capacity), -Deltah) * deposition_rate
-                    terrain[*self.ipos] += s_diff
-
-                # ---Erosion
-                # If it carries less sediment than its capacity adjust until capacity
-                else:
-                    s_diff = - min((capacity-self.sediment), -Deltah) * erosion_rate
-
-                    xi, yi = self.ipos
-                    for i in range(-self.erosion_radius, self.erosion_radius):
-                        for j in range(-self.erosion_radius, self.erosion_radius):
-                            terrain[xi+i, yi+j] += s_diff * self.kernel[i + self.erosion_radius, j + self.erosion_radius]
-
-                self.sediment -= s_diff
-                
-
-            # Set new index position
-            self.ipos = np.array(self.pos, int)
-
-            # Evaporation
-            self.volume *= (1-evaporation_rate*dt)
-            
-            if self.volume <= min_volume:
-                self.inbounds = False
-                # print("droplet evaporated")
-                terrain[*self.ipos] += self.sediment
-                return
+    os.chdir(log_dir)
 
     # Terrain generation
     pnoise_kwargs = {"octaves":4,           # Number of noise layers
@@ -210,41 +150,49 @@ def main():
                  "base": 74,            # Base seed for the noise (optional)
                  }           
 
-    terrain = get_terrain(shape, scale, pnoise_kwargs)
-    np.savetxt("terrain_0.txt", terrain, delimiter = "\t")
+    terrain = get_fast_terrain(shape, scale, pnoise_kwargs)
+    save_terrain("terrain_0", terrain, args.save_txt)
 
     # terrain = np.loadtxt("terrain_0.txt", delimiter = "\t")
-    # Gradiente
-    grad_terrain = np.gradient(terrain)
+    # Gradiente, las dos componentes en un solo array (height, width, 2)
+    grad_terrain = np.stack(np.gradient(terrain), axis=-1)
+    # Mascara auxiliar para actualizar el gradiente, simulate_batch la deja en False
+    dirty = np.zeros(shape, dtype=bool)
+    if args.backend == "cupy":
+        # Todo queda en la GPU durante la simulacion, solo se copia para guardar
+        terrain, grad_terrain, dirty = cp.asarray(terrain), cp.asarray(grad_terrain), cp.asarray(dirty)
     
 
     # Erosion simulation
-    steps = []
-    speeds = []
+    steps = np.empty(cycles*N_droplets, dtype=np.int32)
+    speeds = np.empty(cycles*N_droplets, dtype=np.float32)
+    n_done = 0 # gotas simuladas hasta ahora
 
-    pepe = droplet(height, width, kernel)
+    # Un solo generador para todo el run, reproducible con la semilla
+    rng = np.random.default_rng(seed)
 
     for c in range(cycles):
         time_start = time.time()
-        for i in range(N_droplets//batch_size):
+        # Todas las posiciones iniciales del ciclo de una
+        cycle_starts = rng.integers([0,0],[height-1, width-1], (N_droplets, 2), dtype=np.int32)
+        for i in range(0, N_droplets, batch_size):
             
             # Hago un Batch antes de actualizar el mapa de gradiente
-            for j in range(batch_size):
-                pepe.reset()
-                i=0
-                while pepe.inbounds and i < 250:
-                    pepe.step(terrain = terrain, grad_terrain=grad_terrain)
-                    i+=1
-
-                steps.append(i)
-                speeds.append(pepe.max_speed)
-            grad_terrain = np.gradient(terrain)
+            starts = cycle_starts[i:i+batch_size]
+            batch_steps, batch_speeds = simulate_batch(terrain, grad_terrain, dirty,
+                                                       starts, params, max_steps)
+
+            steps[n_done:n_done+len(starts)] = batch_steps
+            speeds[n_done:n_done+len(starts)] = batch_speeds
+            n_done += len(starts)
             
-        print(f"mean steps: {np.mean(steps)}")
-        print(f"mean max speed: {np.mean(speeds)}")
-        print(f"absolute max speed: {np.max(speeds)}")
+        print(f"mean steps: {steps[:n_done].mean()}")
+        print(f"mean max speed: {speeds[:n_done].mean()}")
+        print(f"absolute max speed: {speeds[:n_done].max()}")
+        print(f"droplets cut at max_steps: {np.count_nonzero(steps[:n_done] >= max_steps)}")
 
-        np.savetxt(f"terrain_{c+1}.txt", terrain, delimiter = "\t")
+        # Snapshots binarios en cada ciclo, el .txt (lento) solo para el terreno final
+        save_terrain(f"terrain_{c+1}", to_host(terrain), args.save_txt and c == cycles - 1)
         
         print(f"cycle finished in {time.time()-time_start} seconds")
 
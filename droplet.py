@@ -1,5 +1,8 @@
+import math
 import numpy as np
 
+from typing import NamedTuple
+
 # particle
 initial_volume = 1
 min_volume = 0.1
@@ -21,44 +24,81 @@ deposition_rate = .25
 initial_sediment = 0
 
 
+class DropletParams(NamedTuple):
+    """
+    Droplet parameters in a single object, used to pass them to the numba kernels
+    """
+    initial_volume: float = initial_volume
+    min_volume: float = min_volume
+    evaporation_rate: float = evaporation_rate
+
+    dt: float = dt
+    g: float = g
+    friction: float = friction
+
+    p_c: float = p_c
+    erosion_rate: float = erosion_rate
+    deposition_rate: float = deposition_rate
+    initial_sediment: float = initial_sediment
+
+
 class droplet():
     """
     Water droplet
     """
-    def __init__(self, height, width, erosion_kernel = np.array([1])):
+    def __init__(self, height, width, erosion_kernel = np.array([1]), params = None, rng = None):
+        """
+        :param height, width: shape of the terrain
+        :param erosion_kernel: square np.array, weights of the erosion around the droplet
+        :param params: DropletParams, the defaults of this module if not given
+        :param rng: np.random.Generator for the starting cells, a new one if not given
+        """
+        self.params = DropletParams() if params is None else params
+        self.rng = np.random.default_rng() if rng is None else rng
+        # Factores constantes de cada paso, calculados una sola vez
+        self.dt_g = self.params.dt * self.params.g
+        self.friction_mul = 1 - self.params.dt * self.params.friction
+        self.evap_mul = 1 - self.params.evaporation_rate * self.params.dt
         self.inbounds = True
         # Dsp esto lo puede tener una clase que sea el terreno
         self.height = height
         self.width = width
         
-        self.sediment = initial_sediment # masa de sedimento
-        self.volume = initial_volume # tamaño gota, se ira evaporando
+        self.sediment = self.params.initial_sediment # masa de sedimento
+        self.volume = self.params.initial_volume # tamaño gota, se ira evaporando
         
         # Erosion Kernel
         if erosion_kernel.shape[0] == erosion_kernel.shape[1]:
             self.erosion_radius = (erosion_kernel.shape[0]-1)//2
             self.kernel = np.array(erosion_kernel)
         else:
-            print("Kernel Error, not square")
+            raise ValueError("Kernel Error, not square")
         
         # Variables dinamicas de la gota
-        self.ipos = np.random.randint([0,0],[height-1, width-1], 2)
-        self.pos = np.array(self.ipos, float)
-        self.vel = np.zeros(2)
+        ix, iy = self.rng.integers([0,0],[height-1, width-1], 2)
+        self.ix, self.iy = int(ix), int(iy)
+        self.px, self.py = float(ix), float(iy)
+        self.vx, self.vy = 0.0, 0.0
 
         self.max_speed = 0
 
+        # Contadores en vez de prints en step, no se resetean con reset()
+        self.skipped_steps = 0 # llamadas a step con la gota ya afuera o evaporada
+        self.out_of_bounds = 0 # veces q la gota salio del mapa
+        self.evaporated = 0 # veces q la gota se evaporo
+
     def reset(self):
         """
         Resets variables
         """
         self.inbounds = True
-        self.sediment = initial_sediment
-        self.volume = initial_volume
+        self.sediment = self.params.initial_sediment
+        self.volume = self.params.initial_volume
 
-        self.ipos = np.random.randint([0,0],[self.height-1, self.width-1], 2)
-        self.pos = np.array(self.ipos, float)
-        self.vel = np.zeros(2)
+        ix, iy = self.rng.integers([0,0],[self.height-1, self.width-1], 2)
+        self.ix, self.iy = int(ix), int(iy)
+        self.px, self.py = float(ix), float(iy)
+        self.vx, self.vy = 0.0, 0.0
 
         self.max_speed = 0
 
@@ -68,9 +108,9 @@ class droplet():
         """
         # Podria cambiar esto por un try:except Index en la parte del step
         # xq creo q el indexing de python ya checkea esto, asi q seria al dope hacerlo dos veces
-        if self.pos[0] >= self.height - 1 or self.pos[1] >= self.width - 1:
+        if self.px >= self.height - 1 or self.py >= self.width - 1:
             return False
-        elif self.pos[0] < 0 or self.pos[1] < 0:
+        elif self.px < 0 or self.py < 0:
             return False
         else: 
             return True
@@ -85,69 +125,96 @@ class droplet():
             return False
             
 
-    def step(self, terrain, grad_terrain):
+    def step(self, terrain, grad_terrain, dirty=None):
+        """
+        Moves the droplet one time step, eroding/depositing on terrain.
+        grad_terrain is np.gradient(terrain) stacked as a (height, width, 2) array.
+        If given, the modified cells of terrain are marked on the boolean array dirty
+        """
         
-        if not self.inbounds:
-            print("step not executed, out of bounds")
+        p = self.params
+        if not self.inbounds or self.volume <= p.min_volume:
+            self.skipped_steps += 1
             return
-        if self.volume <= min_volume:
-            print("step not executed, droplet evaporated")
-            return
-
-        # Dinamica
-        slope = np.array((grad_terrain[0][*self.ipos],grad_terrain[1][*self.ipos]))
 
-        self.vel -= dt*slope*g
-        self.pos += dt*self.vel # + dt**2 * slope * g / 2
-        self.vel *= (1-dt*friction)
+        # Dinamica, la pendiente interpolada bilinealmente en la posicion de la gota
+        # Estado en escalares, sin arrays de 2 elementos por paso
+        ix, iy = self.ix, self.iy
+        fx, fy = self.px - ix, self.py - iy
+        w00, w10, w01, w11 = (1-fx)*(1-fy), fx*(1-fy), (1-fx)*fy, fx*fy
+        sx = (w00*grad_terrain[ix, iy, 0] + w10*grad_terrain[ix+1, iy, 0]
+              + w01*grad_terrain[ix, iy+1, 0] + w11*grad_terrain[ix+1, iy+1, 0])
+        sy = (w00*grad_terrain[ix, iy, 1] + w10*grad_terrain[ix+1, iy, 1]
+              + w01*grad_terrain[ix, iy+1, 1] + w11*grad_terrain[ix+1, iy+1, 1])
+
+        self.vx -= self.dt_g*sx
+        self.vy -= self.dt_g*sy
+        self.px += p.dt*self.vx # + dt**2 * slope * g / 2
+        self.py += p.dt*self.vy
+        self.vx *= self.friction_mul
+        self.vy *= self.friction_mul
         
         # Check q esta en la grilla
         if not self.is_inbounds():
-            # print("out of bounds")
+            self.out_of_bounds += 1
             self.inbounds = False
             return 
 
         # Erosion/Sedimentation
-        Deltah = terrain[*np.array(self.pos,int)] - terrain[*self.ipos]
+        nx, ny = int(self.px), int(self.py)
+        Deltah = terrain[nx, ny] - terrain[self.ix, self.iy]
         if not (Deltah == 0):
-            speed = np.sqrt(self.vel.dot(self.vel))
+            speed = math.sqrt(self.vx*self.vx + self.vy*self.vy)
             if speed > self.max_speed:
                 self.max_speed = speed
 
-            capacity = -Deltah * speed * self.volume * p_c
+            capacity = -Deltah * speed * self.volume * p.p_c
 
             # ---Sedimentation
             # If it goes uphill all sediment is deposited until Deltah gets to 0
             if Deltah > 0:
-                s_diff = min(self.sediment, Deltah) * deposition_rate
-                terrain[*self.ipos] += s_diff
+                s_diff = min(self.sediment, Deltah) * p.deposition_rate
+                terrain[self.ix, self.iy] += s_diff
+                if dirty is not None:
+                    dirty[self.ix, self.iy] = True
 
             # If it carries more sediment than its capacity adjust until capacity or Deltah gets to 0
             elif self.sediment > capacity:
-                s_diff = min((self.sediment-capacity), -Deltah) * deposition_rate
-                terrain[*self.ipos] += s_diff
+                s_diff = min((self.sediment-capacity), -Deltah) * p.deposition_rate
+                terrain[self.ix, self.iy] += s_diff
+                if dirty is not None:
+                    dirty[self.ix, self.iy] = True
 
             # ---Erosion
             # If it carries less sediment than its capacity adjust until capacity
             else:
-                s_diff = - min((capacity-self.sediment), -Deltah) * erosion_rate
-
-                xi, yi = self.ipos
-                for i in range(-self.erosion_radius, self.erosion_radius):
-                    for j in range(-self.erosion_radius, self.erosion_radius):
-                        terrain[xi+i, yi+j] += s_diff * self.kernel[i + self.erosion_radius, j + self.erosion_radius]
+                s_diff = - min((capacity-self.sediment), -Deltah) * p.erosion_rate
+
+                # Todo el kernel de una, centrado en la gota. En el borde se recorta y el peso
+                # de lo q queda afuera va al centro, asi se erosiona la misma masa
+                r = self.erosion_radius
+                xi, yi = self.ix, self.iy
+                x0, x1 = max(xi-r, 0), min(xi+r+1, self.height)
+                y0, y1 = max(yi-r, 0), min(yi+r+1, self.width)
+                kernel = self.kernel[x0-xi+r:x1-xi+r, y0-yi+r:y1-yi+r]
+                terrain[x0:x1, y0:y1] += s_diff * kernel
+                terrain[xi, yi] += s_diff * (self.kernel.sum() - kernel.sum())
+                if dirty is not None:
+                    dirty[x0:x1, y0:y1] = True
 
             self.sediment -= s_diff
             
 
         # Set new index position
-        self.ipos = np.array(self.pos, int)
+        self.ix, self.iy = nx, ny
 
         # Evaporation
-        self.volume *= (1-evaporation_rate*dt)
+        self.volume *= self.evap_mul
         
-        if self.volume <= min_volume:
+        if self.volume <= p.min_volume:
             self.inbounds = False
-            # print("droplet evaporated")
-            terrain[*self.ipos] += self.sediment
+            self.evaporated += 1
+            terrain[self.ix, self.iy] += self.sediment
+            if dirty is not None:
+                dirty[self.ix, self.iy] = True
             return
\ No newline at end of file
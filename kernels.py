@@ -0,0 +1,216 @@
+import numpy as np
+
+from numba import njit, prange
+
+# Numba version of the droplet simulation. Same physics as droplet.step but the
+# droplet state lives in plain scalars and the parameters come in a DropletParams,
+# so the whole trajectory of a droplet runs compiled.
+# The droplets of a batch run in parallel: terrain is only read during the batch,
+# each droplet writes the changes it makes to its own buffer of (flat index, delta)
+# and they are all added to terrain once the batch is over, refreshing the gradient
+# only around the modified cells
+
+
+@njit(fastmath=True, cache=True)
+def interpolate_gradient(grad, px, py, ix, iy):
+    """
+    Bilinear interpolation of grad at position (px, py), inside cell (ix, iy)
+
+    :returns: the two components of the gradient
+    """
+    fx, fy = px - ix, py - iy
+    w00 = (1 - fx) * (1 - fy)
+    w10 = fx * (1 - fy)
+    w01 = (1 - fx) * fy
+    w11 = fx * fy
+    gx = (w00 * grad[ix, iy, 0] + w10 * grad[ix + 1, iy, 0]
+          + w01 * grad[ix, iy + 1, 0] + w11 * grad[ix + 1, iy + 1, 0])
+    gy = (w00 * grad[ix, iy, 1] + w10 * grad[ix + 1, iy, 1]
+          + w01 * grad[ix, iy + 1, 1] + w11 * grad[ix + 1, iy + 1, 1])
+    return gx, gy
+
+
+@njit(fastmath=True, cache=True)
+def step(px, py, vx, vy, ix, iy, sediment, volume, terrain, grad, params,
+         delta_idx, delta_val, n_deltas):
+    """
+    Moves a droplet one time step, eroding/depositing on terrain
+
+    :param px, py, vx, vy: position and velocity of the droplet
+    :param ix, iy: cell the droplet is on
+    :param sediment, volume: sediment carried and volume of the droplet
+    :param terrain: np.array with the terrain, only read
+    :param grad: gradient of the terrain as a single (height, width, 2) array
+    :param params: DropletParams
+    :param delta_idx, delta_val: buffers where the changes to terrain get written
+        as (flat index, delta), the first n_deltas are already taken
+
+    :returns: new (px, py, vx, vy, ix, iy, sediment, volume, n_deltas), the speed
+        (0 if it wasn't computed) and whether the droplet left the map or evaporated
+    """
+    height, width = terrain.shape
+    # Factores constantes, numba los saca del loop de simulate_droplet al compilar
+    dt_g = params.dt * params.g
+    friction_mul = 1 - params.dt * params.friction
+    evap_mul = 1 - params.evaporation_rate * params.dt
+
+    # Dinamica, la pendiente interpolada en la posicion de la gota
+    # (la gota nunca llega a la ultima fila/columna, asi q ix+1, iy+1 siempre existen)
+    sx, sy = interpolate_gradient(grad, px, py, ix, iy)
+    vx -= dt_g * sx
+    vy -= dt_g * sy
+    px += params.dt * vx
+    py += params.dt * vy
+    vx *= friction_mul
+    vy *= friction_mul
+
+    # Check q esta en la grilla
+    if px >= height - 1 or py >= width - 1 or px < 0 or py < 0:
+        return px, py, vx, vy, ix, iy, sediment, volume, n_deltas, 0.0, True
+
+    # Erosion/Sedimentation
+    nx, ny = int(px), int(py)
+    Deltah = terrain[nx, ny] - terrain[ix, iy]
+    speed = 0.0
+    if Deltah != 0:
+        speed = np.sqrt(vx * vx + vy * vy)
+        capacity = -Deltah * speed * volume * params.p_c
+
+        # ---Sedimentation
+        # If it goes uphill all sediment is deposited until Deltah gets to 0
+        if Deltah > 0:
+            s_diff = min(sediment, Deltah) * params.deposition_rate
+            delta_idx[n_deltas] = ix * width + iy
+            delta_val[n_deltas] = s_diff
+            n_deltas += 1
+
+        # If it carries more sediment than its capacity adjust until capacity or Deltah gets to 0
+        elif sediment > capacity:
+            s_diff = min((sediment - capacity), -Deltah) * params.deposition_rate
+            delta_idx[n_deltas] = ix * width + iy
+            delta_val[n_deltas] = s_diff
+            n_deltas += 1
+
+        # ---Erosion
+        # If it carries less sediment than its capacity adjust until capacity
+        else:
+            s_diff = - min((capacity - sediment), -Deltah) * params.erosion_rate
+
+            # 3x3 erosion kernel [[1,2,1],[2,4,2],[1,2,1]]/16 centred on the droplet cell.
+            # On the border the taps outside the grid are dropped and their weight goes
+            # to the centre, so the eroded mass doesn't change (same as droplet.step)
+            centre = 4 / 16
+            for i in range(-1, 2):
+                for j in range(-1, 2):
+                    if i == 0 and j == 0:
+                        continue
+                    w = (2 - abs(i)) * (2 - abs(j)) / 16
+                    if 0 <= ix + i < height and 0 <= iy + j < width:
+                        delta_idx[n_deltas] = (ix + i) * width + iy + j
+                        delta_val[n_deltas] = s_diff * w
+                        n_deltas += 1
+                    else:
+                        centre += w
+            delta_idx[n_deltas] = ix * width + iy
+            delta_val[n_deltas] = s_diff * centre
+            n_deltas += 1
+
+        sediment -= s_diff
+
+    # Set new index position
+    ix, iy = nx, ny
+
+    # Evaporation
+    volume *= evap_mul
+
+    if volume <= params.min_volume:
+        delta_idx[n_deltas] = ix * width + iy
+        delta_val[n_deltas] = sediment
+        n_deltas += 1
+        return px, py, vx, vy, ix, iy, sediment, volume, n_deltas, speed, True
+
+    return px, py, vx, vy, ix, iy, sediment, volume, n_deltas, speed, False
+
+
+@njit(fastmath=True, cache=True)
+def simulate_droplet(terrain, grad, x0, y0, params, max_steps, delta_idx, delta_val):
+    """
+    Runs a droplet starting at cell (x0, y0) until it leaves the map,
+    evaporates or reaches max_steps. Its changes to terrain are written to
+    delta_idx, delta_val (see step)
+
+    :returns: number of steps, max speed of the droplet and number of changes written
+    """
+    px, py = float(x0), float(y0)
+    vx, vy = 0.0, 0.0
+    ix, iy = x0, y0
+    sediment = float(params.initial_sediment)
+    volume = float(params.initial_volume)
+
+    n_deltas = 0
+    max_speed = 0.0
+    steps = 0
+    done = False
+    while not done and steps < max_steps:
+        px, py, vx, vy, ix, iy, sediment, volume, n_deltas, speed, done = step(
+            px, py, vx, vy, ix, iy, sediment, volume, terrain, grad, params,
+            delta_idx, delta_val, n_deltas)
+        if speed > max_speed:
+            max_speed = speed
+        steps += 1
+
+    return steps, max_speed, n_deltas
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def simulate_batch(terrain, grad, dirty, starts, params, max_steps):
+    """
+    Runs a batch of droplets in parallel, one for each (x0, y0) row of starts.
+    Their changes are added to terrain at the end and grad is updated around them.
+    dirty is a boolean scratch array the size of terrain, all False before and after
+
+    :returns: steps and max speed of each droplet
+    """
+    height, width = terrain.shape
+    n_droplets = starts.shape[0]
+
+    # At most a droplet modifies the 9 erosion kernel cells on every step, plus the final deposit
+    capacity = max_steps * 9 + 1
+    delta_idx = np.empty((n_droplets, capacity), dtype=np.int64)
+    delta_val = np.empty((n_droplets, capacity), dtype=terrain.dtype)
+    n_deltas = np.empty(n_droplets, dtype=np.int64)
+
+    steps = np.empty(n_droplets, dtype=np.int64)
+    speeds = np.empty(n_droplets, dtype=np.float32)
+
+    for k in prange(n_droplets):
+        steps[k], speeds[k], n_deltas[k] = simulate_droplet(
+            terrain, grad, starts[k, 0], starts[k, 1], params, max_steps,
+            delta_idx[k], delta_val[k])
+
+    # Serial reduction, droplets of the same batch can modify the same cells.
+    # A modified cell changes the gradient of its 3x3 neighbourhood, those cells
+    # get listed once (dirty marks the ones already listed)
+    stale = np.empty(height * width, dtype=np.int64)
+    n_stale = 0
+    for k in range(n_droplets):
+        for n in range(n_deltas[k]):
+            i, j = divmod(delta_idx[k, n], width)
+            terrain[i, j] += delta_val[k, n]
+            for gi in range(max(i - 1, 0), min(i + 2, height)):
+                for gj in range(max(j - 1, 0), min(j + 2, width)):
+                    if not dirty[gi, gj]:
+                        dirty[gi, gj] = True
+                        stale[n_stale] = gi * width + gj
+                        n_stale += 1
+
+    # Central differences, one sided on the borders (same as np.gradient)
+    for n in range(n_stale):
+        i, j = divmod(stale[n], width)
+        up, down = max(i - 1, 0), min(i + 1, height - 1)
+        left, right = max(j - 1, 0), min(j + 1, width - 1)
+        grad[i, j, 0] = (terrain[down, j] - terrain[up, j]) / (down - up)
+        grad[i, j, 1] = (terrain[i, right] - terrain[i, left]) / (right - left)
+        dirty[i, j] = False
+
+    return steps, speeds
@@ -10,13 +10,167 @@ def get_terrain(shape, scale, noise_kwargs):
     :param scale: defines the size of the features (masomenos)
     :param noise_kwargs: arguments for noise.pnoise2
 
-    :returns terrain: np.array with values between 0 and 1
+    :returns terrain: np.array (float32) with values between 0 and 1
     """
-    terrain = np.zeros(shape)
+    xs = np.arange(shape[0]) / scale
+    ys = np.arange(shape[1]) / scale
 
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            terrain[i][j] = pnoise2(i / scale, j / scale, **noise_kwargs)
+    # frompyfunc broadcasts pnoise2 over the whole grid without the python double loop
+    noise = np.frompyfunc(lambda x, y: pnoise2(x, y, **noise_kwargs), 2, 1)
+    terrain = noise(xs[:, None], ys[None, :]).astype(np.float32)
 
-    return (terrain - terrain.min()) / (terrain.max() - terrain.min())
+    return (terrain - terrain.min()) / np.ptp(terrain)
 
+
+# Permutation table and 2D gradients used by noise.pnoise2 (Ken Perlin's improved noise)
+_PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225,
+    140, 36, 103, 30, 69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148,
+    247, 120, 234, 75, 0, 26, 197, 62, 94, 252, 219, 203, 117, 35, 11, 32,
+    57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171, 168, 68, 175,
+    74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122,
+    60, 211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54,
+    65, 25, 63, 161, 1, 216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169,
+    200, 196, 135, 130, 116, 188, 159, 86, 164, 100, 109, 198, 173, 186, 3, 64,
+    52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118, 126, 255, 82, 85, 212,
+    207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170, 213,
+    119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9,
+    129, 22, 39, 253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104,
+    218, 246, 97, 228, 251, 34, 242, 193, 238, 210, 144, 12, 191, 179, 162, 241,
+    81, 51, 145, 235, 249, 14, 239, 107, 49, 192, 214, 31, 181, 199, 106, 157,
+    184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254, 138, 236, 205, 93,
+    222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180,
+] * 2, dtype=np.int64)
+
+_GRAD2 = np.array([[1, 1], [-1, 1], [1, -1], [-1, -1],
+                   [1, 0], [-1, 0], [1, 0], [-1, 0],
+                   [0, 1], [0, -1], [0, 1], [0, -1],
+                   [1, 0], [-1, 0], [0, -1], [0, 1]], dtype=np.float32)
+
+# Gradient components for every hash value, grad2(PERM[h], x, y) = x*_GX[h] + y*_GY[h]
+_GX = _GRAD2[_PERM & 15, 0]
+_GY = _GRAD2[_PERM & 15, 1]
+
+
+def _noise2(x, y, repeatx, repeaty, base):
+    """
+    Single octave of perlin noise evaluated on broadcastable arrays, port of noise2 in noise/_perlin.c
+    """
+    i = np.floor(np.fmod(x, repeatx)).astype(np.int64)
+    j = np.floor(np.fmod(y, repeaty)).astype(np.int64)
+    ii = np.fmod(i + 1, repeatx).astype(np.int64)
+    jj = np.fmod(j + 1, repeaty).astype(np.int64)
+    i = (i & 255) + base
+    j = (j & 255) + base
+    ii = (ii & 255) + base
+    jj = (jj & 255) + base
+
+    x = x - np.floor(x)
+    y = y - np.floor(y)
+    fx = x*x*x * (x * (x * 6 - 15) + 10)
+    fy = y*y*y * (y * (y * 6 - 15) + 10)
+
+    # & 511 keeps big bases inside the table (the C version reads past it)
+    A = _PERM[i & 511]
+    AA = _PERM[(A + j) & 511]
+    AB = _PERM[(A + jj) & 511]
+    B = _PERM[ii & 511]
+    BA = _PERM[(B + j) & 511]
+    BB = _PERM[(B + jj) & 511]
+
+    g_AA = x * _GX[AA] + y * _GY[AA]
+    g_BA = (x - 1) * _GX[BA] + y * _GY[BA]
+    g_AB = x * _GX[AB] + (y - 1) * _GY[AB]
+    g_BB = (x - 1) * _GX[BB] + (y - 1) * _GY[BB]
+
+    bottom = g_AA + fx * (g_BA - g_AA)
+    top = g_AB + fx * (g_BB - g_AB)
+    return bottom + fy * (top - bottom)
+
+
+def fast_perlin(shape, scale, octaves=1, persistence=0.5, lacunarity=2.0, repeatx=1024, repeaty=1024, base=0):
+    """
+    Perlin noise for the whole grid at once, gives the same values as
+    calling noise.pnoise2(i / scale, j / scale, ...) on every cell
+
+    :param shape: shape of the np.array
+    :param scale: defines the size of the features (masomenos)
+    :param octaves, persistence, lacunarity, repeatx, repeaty, base: same as in noise.pnoise2
+
+    :returns noise: np.array (float32) with values roughly between -1 and 1
+    """
+    # Rows and columns are kept as (H, 1) and (1, W), everything that only depends on
+    # one coordinate is computed once per row/column and broadcasted at the end
+    x = (np.arange(shape[0]) / scale).astype(np.float32)[:, None]
+    y = (np.arange(shape[1]) / scale).astype(np.float32)[None, :]
+
+    freq = np.float32(1)
+    amp = np.float32(1)
+    max_amp = np.float32(0)
+    total = np.zeros(shape, dtype=np.float32)
+    for _ in range(octaves):
+        total += _noise2(x * freq, y * freq, np.float32(repeatx) * freq, np.float32(repeaty) * freq, base) * amp
+        max_amp += amp
+        freq *= np.float32(lacunarity)
+        amp *= np.float32(persistence)
+
+    return total / max_amp
+
+
+def get_fast_terrain(shape, scale, noise_kwargs):
+    """
+    Same as get_terrain but using fast_perlin instead of a pnoise2 call per cell
+
+    :param shape: shape of the np.array
+    :param scale: defines the size of the features (masomenos)
+    :param noise_kwargs: arguments for noise.pnoise2
+
+    :returns terrain: np.array (float32) with values between 0 and 1
+    """
+    # float32 alcanza para el terreno (normalizado entre 0 y 1)
+    terrain = fast_perlin(shape, scale, **noise_kwargs)
+
+    return (terrain - terrain.min()) / np.ptp(terrain)
+
+
+def update_gradient(terrain, grad_terrain, dirty):
+    """
+    Updates grad_terrain in place, only around the modified cells.
+    Changing a cell changes the gradient of its neighbours, so every dirty cell
+    refreshes its 3x3 neighbourhood
+
+    :param terrain: np.array with the current terrain
+    :param grad_terrain: gradient of the terrain to update, np.gradient(terrain) stacked as a (height, width, 2) array
+    :param dirty: boolean np.array, True on the cells of terrain that were modified
+    """
+    height, width = terrain.shape
+
+    rows, cols = np.nonzero(dirty)
+    if rows.size == 0:
+        return
+
+    offsets = np.arange(-1, 2)
+    rows = np.clip(rows[:, None, None] + offsets[None, :, None], 0, height - 1)
+    cols = np.clip(cols[:, None, None] + offsets[None, None, :], 0, width - 1)
+    rows, cols = np.divmod(np.unique(rows * width + cols), width)
+
+    # Central differences, one sided on the borders (same as np.gradient)
+    up, down = np.maximum(rows - 1, 0), np.minimum(rows + 1, height - 1)
+    left, right = np.maximum(cols - 1, 0), np.minimum(cols + 1, width - 1)
+
+    grad_terrain[rows, cols, 0] = (terrain[down, cols] - terrain[up, cols]) / (down - up)
+    grad_terrain[rows, cols, 1] = (terrain[rows, right] - terrain[rows, left]) / (right - left)
+
+
+def save_terrain(name, terrain, save_txt=False):
+    """
+    Saves the terrain as name.npy (binary, what blender.py reads first) and,
+    only if asked, also as a tab separated name.txt
+
+    :param name: file name without extension
+    :param terrain: np.array with the terrain
+    :param save_txt: also write the text version
+    """
+    np.save(f"{name}.npy", terrain)
+    if save_txt:
+        np.savetxt(f"{name}.txt", terrain, delimiter = "\t", fmt="%.6f")